@@ -15,8 +15,8 @@ Send Task:
 - delete Task in outbox
 - timeout 10 sek
 
-Separate process, handling all communication with modem. Uses a queue
-for serialisation of Tasks. This ensures only one transaction is 
+Separate thread, handling all communication with modem. Uses a queue
+for serialisation of Tasks. This ensures only one transaction is
 in progress with the USB modem.
 
 License:
@@ -49,11 +49,12 @@ import time
 import logging
 import logging.handlers
 import urllib.parse
-import xmltodict
-import requests
+import urllib3
 import argparse
-import multiprocessing
+import queue
+import threading
 
+from lxml import etree
 from orderedattrdict import AttrDict
 
 from lib_log import log
@@ -63,6 +64,82 @@ from lib_log import log
 BASE_URL = 'http://192.168.8.1'
 COOKIE_URL = '/html/index.html'
 
+# ----- HTTP connection pool -------------------------------------------------
+
+# One shared urllib3 pool so all modem calls reuse the same TCP
+# connection (HTTP keep-alive). We talk to a single host and handle
+# cookie/token headers ourselves, so the requests layer on top of
+# urllib3 only added per-call overhead
+
+_http = urllib3.PoolManager(
+    num_pools=1,
+    maxsize=4,
+    block=False,
+    retries=urllib3.Retry(total=2, backoff_factor=0.1),
+    headers={'User-Agent': 'playsms_hilink_driver'})
+
+
+def get_http():
+    """
+    Return the shared urllib3 pool, so it can be replaced in tests
+    """
+    return _http
+
+
+# ----- XML parsing ----------------------------------------------------------
+
+# The modem XML schemas are fixed, so the xpath expressions can be
+# compiled once at module load
+
+_MSGS_XPATH = etree.XPath("/response/Messages/Message[SmsType='1']")
+_FIELDS = ('Index', 'Phone', 'SmsType', 'Content')
+
+
+# ----- XML request templates ------------------------------------------------
+
+# The request bodies are mostly constant, build them with one %
+# substitution instead of repeated bytes concatenation
+
+_SMS_LIST_TPL = (
+    b'<?xml version="1.0" encoding="UTF-8"?>\n'
+    b"<request>\n"
+    b"  <PageIndex>1</PageIndex>\n"
+    b"  <ReadCount>10</ReadCount>\n"
+    b"  <BoxType>%s</BoxType>"
+    b"  <SortType>0</SortType>"
+    b"  <Ascending>0</Ascending>"
+    b"  <UnreadPreferred>0</UnreadPreferred>"
+    b"</request>\n"
+    )
+
+# delete-sms accepts several <Index> elements in one request
+_DELETE_SMS_TPL = (
+    b'<?xml version="1.0" encoding="UTF-8"?>\n'
+    b"<request>\n"
+    b"%s"
+    b"</request>\n"
+    )
+
+_DELETE_SMS_INDEX_TPL = b"  <Index>%s</Index>\n"
+
+_SEND_SMS_TPL = (
+    b'<?xml version="1.0" encoding="UTF-8"?>\n'
+    b"<request>\n"
+    b"  <Index>-1</Index>\n"
+    b"  <Phones>\n"
+    b"%s"
+    b"  </Phones>\n"
+    b"  <Sca></Sca>\n"
+    b"  <Content>%s</Content>\n"
+    b"  <Length>%s</Length>\n"
+    b"  <Reserved>1</Reserved>\n"
+    b"  <Date>%s</Date>\n"
+    b"</request>\n"
+    )
+
+_SEND_SMS_PHONE_TPL = b"    <Phone>%s</Phone>\n"
+
+
 # ----- Helper functions -----------------------------------------------------
 
 datetime_str_format = "%Y-%m-%d %H:%M:%S"
@@ -72,244 +149,272 @@ def now_dt():
     return datetime.datetime.now().replace(microsecond=0)
 
 
+_now_str_cache = [0, ""]
+
+
 def now_str():
-    return now_dt().strftime(datetime_str_format)
+    # fixed format with no locale-dependent fields, an f-string is
+    # several times faster than strftime. The format has 1 second
+    # granularity, so the result is cached until the second changes
+    t = int(time.time())
+    if t != _now_str_cache[0]:
+        n = datetime.datetime.now()
+        _now_str_cache[0] = t
+        _now_str_cache[1] = f"{n.year:04d}-{n.month:02d}-{n.day:02d} {n.hour:02d}:{n.minute:02d}:{n.second:02d}"
+    return _now_str_cache[1]
 
 
 class Task:
     def __init__(self, action=None):
         self.action = action
+        self.error = None       # set when the worker failed the task
+        # each task carries its own reply queue, so concurrent callers
+        # cannot receive each other's results
+        self.reply = queue.Queue(maxsize=1)
 
 
 class USB_modem:
     """
     Manage the USB modem via hilink
-    
-    Starts a background process, which does all communication with the  modem.
+
+    Starts a background thread, which does all communication with the  modem.
     This serializes all communication with the modem
     """
 
-    def __init__(self):
-        self.session = requests.Session()
-        
-        self.task_queue = multiprocessing.Queue()       # Tasks to worker
-        self.result_queue = multiprocessing.Queue()     # Tasks from worker
-        self.p = multiprocessing.Process(target=self.background_worker, args=(self.task_queue, self.result_queue))
-        self.p.start()
+    def __init__(self, ucs2_hex_content=False):
+        self.http = _http
+        self._sess_cache = None     # cached (session, token) from SesTokInfo
+        self.ucs2_hex_content = ucs2_hex_content
+
+        self.task_queue = queue.Queue()         # Tasks to worker
+        self.t = threading.Thread(target=self.background_worker, args=(self.task_queue,), daemon=True)
+        self.t.start()
 
     # ----------------------------------------------------------------------
-    # Here is all background process and helper functions
+    # Here is all background thread and helper functions
     # ----------------------------------------------------------------------
 
-    def background_worker(self, task_queue, result_queue):
+    def background_worker(self, task_queue):
         """
-        This method is running as a separate process
+        This method is running as a separate thread
         """
-        r = self.session.get(BASE_URL + COOKIE_URL)
-        # except requests.exceptions.ConnectionError as err:
+        r = self.http.request('GET', BASE_URL + COOKIE_URL)
+        # except urllib3.exceptions.HTTPError as err:
         
         while True:
             task = task_queue.get()
             
             res = Task(action='result')
-            if task.action == 'list_received_sms':
-                messages = self.b_get_sms_list()
-                res.messages = messages
-                self.result_queue.put(res)
-
-            elif task.action == 'list_sent_sms':
-                messages = self.b_get_sms_list(outbox=True)
-                res.messages = messages
-                self.result_queue.put(res)
+            try:
+                if task.action == 'list_received_sms':
+                    messages = self.b_get_sms_list()
+                    res.messages = messages
+                    task.reply.put(res)
 
-            elif task.action == 'send_sms':
-    
-                # delete any lingering SMS in outbox
-                while True:
+                elif task.action == 'list_sent_sms':
                     messages = self.b_get_sms_list(outbox=True)
-                    if len(messages):
-                        for message in messages:
-                            self.b_delete_sms(message.Index)
-                    else:
-                        break
+                    res.messages = messages
+                    task.reply.put(res)
 
-                # send SMS
-                res.index = -1
-                self.b_send_sms(numbers=task.numbers, text=task.text)
+                elif task.action == 'send_sms':
+    
+                    # delete any lingering SMS in outbox, all in one request
+                    while True:
+                        messages = self.b_get_sms_list(outbox=True)
+                        if len(messages):
+                            self.b_delete_sms([message.Index for message in messages])
+                        else:
+                            break
+
+                    # send SMS
+                    res.index = -1
+                    self.b_send_sms(numbers=task.numbers, text=task.text)
                 
-                # list SMS in outbox.
-                # It takes some time until the sent message is visible
-                # in the outbox. Wait for it
-                for i in range(0,5):
-                    time.sleep(1)
-                    messages = self.b_get_sms_list(outbox=True)
-                    
-                if len(messages):
-                    res.index = messages[0].Index
-                    if len(messages) > 1:
-                        log.warning("After SMS sent, more than one message in outbox")
+                    # list SMS in outbox.
+                    # It takes some time until the sent message is visible
+                    # in the outbox. Poll with increasing delay, stop as
+                    # soon as it shows up (max total wait ~5 sec)
+                    delay = 0.1
+                    for i in range(0, 8):
+                        time.sleep(delay)
+                        messages = self.b_get_sms_list(outbox=True)
+                        if messages:
+                            break
+                        delay = min(delay * 1.7, 1.0)
+
+
+                    if len(messages):
+                        res.index = messages[0].Index
+                        if len(messages) > 1:
+                            log.warning("After SMS sent, more than one message in outbox")
                         
-                    # delete sms in outbox
-                    self.b_delete_sms(res.index)
-                else:
-                    log.error("Sent SMS was not stored in outbox")
+                        # delete sms in outbox
+                        self.b_delete_sms(res.index)
+                    else:
+                        log.error("Sent SMS was not stored in outbox")
 
-                self.result_queue.put(res)
+                    task.reply.put(res)
 
-            elif task.action == 'receive_sms':
-                self.result_queue.put(res)
+                elif task.action == 'receive_sms':
+                    task.reply.put(res)
 
-            elif task.action == 'delete_sms':
-                index = task.index
-                r = self.b_delete_sms(index)
-                self.result_queue.put(res)
+                elif task.action == 'delete_sms':
+                    index = task.index
+                    r = self.b_delete_sms(index)
+                    task.reply.put(res)
             
-            elif task.action == 'stop':
-                print("Ending background process")
-                self.result_queue.put(res)
-                return  # this quits the background process
+                elif task.action == 'stop':
+                    print("Ending background worker")
+                    task.reply.put(res)
+                    return  # this quits the background thread
 
-            else:
-                print("Unknown task: %s" % task.action)
+                else:
+                    print("Unknown task: %s" % task.action)
+            except Exception as err:
+                # one failed task must not kill the serializer thread,
+                # and the caller is blocked on task.reply.get()
+                log.error("Task %s failed: %s", task.action, err)
+                res.error = err
+                task.reply.put(res)
 
 
     def b_get_session(self):
         """
         All communication with the USB modem needs a valid session
+        The session/token is cached, and refreshed when the modem
+        rejects it (see b_api_post)
+        """
+        if self._sess_cache is None:
+            r = self.http.request('GET', BASE_URL + "/api/webserver/SesTokInfo")
+            root = etree.fromstring(r.data)
+            session = root.findtext("SesInfo")  #cookie
+            token = root.findtext("TokInfo")    #token
+
+            # the headers are constant until the session is refreshed,
+            # build them once and reuse for every request
+            headers = {
+                'Cookie': session,
+                '__RequestVerificationToken': token,
+                'charset': 'UTF-8',
+                'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
+                }
+            self._sess_cache = (session, token, headers)
+        return self._sess_cache
+
+
+    def b_api_post(self, api_url, post_data):
+        """
+        POST a request to the modem API and return the parsed response
+        as an lxml element
+
+        If the modem rejects the cached session/token (error code
+        125002/125003), fetch a new one and retry once
         """
-        session_token = xmltodict.parse(self.session.get(BASE_URL +\
-            "/api/webserver/SesTokInfo").text).get('response',None)
-        session = session_token.get("SesInfo")  #cookie
-        token = session_token.get("TokInfo")    #token
-        return session, token
+        for attempt in range(2):
+            session, token, headers = self.b_get_session()
+            r = self.http.request('POST', api_url, body=post_data, headers=headers)
+            root = etree.fromstring(r.data)
+            if root.tag == 'error' and root.findtext('code') in ('125002', '125003'):
+                # session/token no longer valid, refresh and retry
+                self._sess_cache = None
+                continue
+
+            # some firmwares rotate the token on every request
+            new_token = r.headers.get('__RequestVerificationToken')
+            if new_token:
+                headers['__RequestVerificationToken'] = new_token
+                self._sess_cache = (session, new_token, headers)
+            return root
+        return root
 
 
     def b_get_sms_list(self, outbox=False):
         """
         Return a list with up to 10 received SMSes
         """
-        session, token = self.b_get_session()
-        headers = {
-            'Cookie': session, 
-            '__RequestVerificationToken': token, 
-            'charset'        : 'UTF-8',
-            'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
-            }
-
         if outbox:
             boxtype = '2'
         else:
             boxtype = '1'
 
         api_url = BASE_URL + "/api/sms/sms-list"
-        post_data =  b""
-        post_data += b'<?xml version="1.0" encoding="UTF-8"?>\n'
-        post_data += b"<request>\n"
-        post_data += b"  <PageIndex>1</PageIndex>\n"
-        post_data += b"  <ReadCount>10</ReadCount>\n"
-        post_data += b"  <BoxType>%s</BoxType>" % boxtype.encode()
-        post_data += b"  <SortType>0</SortType>"
-        post_data += b"  <Ascending>0</Ascending>"
-        post_data += b"  <UnreadPreferred>0</UnreadPreferred>"
-        post_data += b"</request>\n"
-        
-        ret = self.session.post(url=api_url, data=post_data, headers=headers).text
-        data = xmltodict.parse(ret)
-        
+        post_data = _SMS_LIST_TPL % boxtype.encode()
+
+        root = self.b_api_post(api_url, post_data)
+
         ret_messages = []
 
-        if 'Messages' in data['response']:
-            messages = data['response']['Messages']
-            if messages is not None:
-                message_list = messages['Message']
-
-                # If we only have one message, it is not returned as a list
-                # so it cannot be iterated over, convert to list.
-                if not isinstance(message_list, list):
-                    message_list = [ message_list ]
-
-                for message in message_list:
-                    if message['SmsType'] == '1':
-                        msg = AttrDict()
-                        for attr in ['Index', 'Phone', 'SmsType', 'Content']:
-                            msg[attr] = message[attr]
-                        if msg['Content'] is None:
-                            msg['Content'] = ' '
-                        msg['Content'] = msg['Content'].encode('latin1').decode('utf8', 'ignore')
-                        ret_messages.append(msg)
-                        print(msg)
+        for message in _MSGS_XPATH(root):
+            msg = AttrDict()
+            for attr in _FIELDS:
+                msg[attr] = message.findtext(attr)
+            content = msg['Content']
+            if content is None:
+                content = ' '
+            elif self.ucs2_hex_content and len(content) >= 4 and \
+                    len(content) % 4 == 0 and \
+                    all(c in '0123456789abcdefABCDEF' for c in content):
+                # Some firmwares return the SMS body as UCS2 hex. Guessing
+                # per message corrupts legitimate all-hex texts, so this is
+                # opt-in per firmware (modem.ucs2_hex_content in config).
+                # If the strict decode fails, keep the raw content
+                try:
+                    content = bytes.fromhex(content).decode('utf-16-be')
+                except UnicodeDecodeError:
+                    pass
+            msg['Content'] = content
+            ret_messages.append(msg)
+            log.debug("RX %s", msg)
 
         return ret_messages
 
 
-    def b_delete_sms(self, index):
+    def b_delete_sms(self, indices):
         """
-        Delete a SMS from the modem.
+        Delete one or more SMS from the modem, in a single request.
+        indices can be a single index, or a list of indices
         """
-        log.info("Delete SMS with index %s" % index)
-        session, token = self.b_get_session()
-        headers = {
-            'Cookie': session, 
-            '__RequestVerificationToken': token, 
-            }
+        if not isinstance(indices, (list, tuple)):
+            indices = [indices]
+        log.info("Delete SMS with index %s", ",".join(str(i) for i in indices))
         api_url = BASE_URL + "/api/sms/delete-sms"
-        post_data = b""
-        post_data += b'<?xml version="1.0" encoding="UTF-8"?>\n'
-        post_data += b"<request>\n"
-        post_data += b"  <Index>%s</Index>\n" % str(index).encode()
-        post_data += b"</request>\n"
-        ret = self.session.post(url=api_url, data=post_data, headers=headers).text
-        data = xmltodict.parse(ret)
-        return data
+        post_data = _DELETE_SMS_TPL % b"".join(
+            _DELETE_SMS_INDEX_TPL % str(i).encode() for i in indices)
+        return self.b_api_post(api_url, post_data)
 
 
     def b_send_sms(self, numbers=None, text=None):
-        log.info("Sending SMS, numbers: %s  Text: %s" % ( ",".join(numbers), text))
-        session, token = self.b_get_session()
+        log.info("Sending SMS, numbers: %s  Text: %s", ",".join(numbers), text)
         api_url = BASE_URL + "/api/sms/send-sms"
         length = str(len(text))
-        headers = {
-            'Cookie': session, 
-            '__RequestVerificationToken': token,
-             "Content-Type":"application/x-www-form-urlencoded; charset=UTF-8"
-            }
-
-        # Build XML structure
-        post_data = b""
-        post_data += b'<?xml version="1.0" encoding="UTF-8"?>\n'
-        post_data += b"<request>\n"
-        post_data += b"  <Index>-1</Index>\n"
-        post_data += b"  <Phones>\n"
-        for number in numbers:
-            post_data += b"    <Phone>%s</Phone>\n" % number.encode()
-        post_data += b"  </Phones>\n"
-        post_data += b"  <Sca></Sca>\n"
-        post_data += b"  <Content>%s</Content>\n" % text.encode()
-        post_data += b"  <Length>%s</Length>\n" % length.encode()
-        post_data += b"  <Reserved>1</Reserved>\n"
-        post_data += b"  <Date>%s</Date>\n" % now_str().encode()
-        post_data += b"</request>\n"
-        
-        ret = self.session.post(url=api_url, data=post_data, headers=headers).text
-        return xmltodict.parse(ret)
+
+        # Build XML structure, one substitution into the template
+        phones = b"".join(_SEND_SMS_PHONE_TPL % number.encode() for number in numbers)
+        post_data = _SEND_SMS_TPL % (phones, text.encode(), length.encode(), now_str().encode())
+
+        return self.b_api_post(api_url, post_data)
 
 
     # ----------------------------------------------------------------------
-    # End of background process and helper functions
+    # End of background thread and helper functions
     # ----------------------------------------------------------------------
 
 
     def list_received_sms(self):
         m = Task(action='list_received_sms')
         self.task_queue.put(m)
-        task = self.result_queue.get()
+        task = m.reply.get()
+        if task.error:
+            raise task.error
         return task.messages
     
 
     def list_sent_sms(self):
         t = Task(action='list_sent_sms')
         self.task_queue.put(t)
-        task = self.result_queue.get()
+        task = t.reply.get()
+        if task.error:
+            raise task.error
         return task.messages
 
 
@@ -318,7 +423,9 @@ class USB_modem:
         t.numbers = numbers
         t.text = text
         self.task_queue.put(t)
-        task = self.result_queue.get()
+        task = t.reply.get()
+        if task.error:
+            raise task.error
         return task.index
 
 
@@ -326,14 +433,16 @@ class USB_modem:
         t = Task(action='receive_sms')
         t.index = index
         self.task_queue.put(t)
-        task = self.result_queue.get()
+        task = t.reply.get()
     
 
     def delete_sms(self, index):
         t = Task(action='delete_sms')
         t.index = index
         self.task_queue.put(t)
-        task = self.result_queue.get()
+        task = t.reply.get()
+        if task.error:
+            raise task.error
         # return task.status
 
 
@@ -25,47 +25,74 @@ License:
 
 import os
 import os.path
-import sys
 import json
-import datetime
-import time
+import pickle
 import threading
+import queue
+import concurrent.futures
 import logging
-import logging.handlers
 import urllib.parse
-import xmltodict
 import requests
 import yaml
 import argparse
 
-from orderedattrdict import AttrDict
+# the libyaml C loader is ~10x faster, fall back to the pure-python
+# loader when pyyaml was built without it
+try:
+    from yaml import CSafeLoader as YamlSafeLoader
+except ImportError:
+    from yaml import SafeLoader as YamlSafeLoader
 
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from socketserver import ThreadingMixIn
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 from lib_log import log
 from lib_usb_modem import USB_modem
 
+# orjson is much faster than stdlib json and returns bytes directly,
+# use it when available
+try:
+    import orjson
+    _json_dumps = orjson.dumps
+except ImportError:
+    def _json_dumps(data):
+        return json.dumps(data).encode()
+
 # ----- start of configuration ------------------------------------------------
 
 CONFIG_FILE = "/etc/playsms_hilink_driver/config.yaml"
 
-# ----- Helper functions -----------------------------------------------------
+# ----- HTTP session ---------------------------------------------------------
 
-datetime_str_format = "%Y-%m-%d %H:%M:%S"
+# One shared session so all playsms callbacks reuse the same TCP connection
+# (HTTP keep-alive) instead of doing a new handshake per request
 
+_session = requests.Session()
+_session.mount('http://', requests.adapters.HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=requests.packages.urllib3.util.retry.Retry(total=2, backoff_factor=0.1)))
+_session.headers.update({
+    'charset': 'UTF-8',
+    'Content-Type': 'application/x-www-form-urlencoded',
+    'User-Agent': 'playsms_hilink_driver',
+    })
 
-def now_dt():
-    return datetime.datetime.now().replace(microsecond=0)
 
+def get_session():
+    """
+    Return the shared requests session, so it can be replaced in tests
+    """
+    return _session
 
-def now_str():
-    return now_dt().strftime(datetime_str_format)
 
+# ----- Helper functions -----------------------------------------------------
 
-def ordered_load(stream, Loader=yaml.Loader, object_pairs_hook=AttrDict):
+def ordered_load(stream, Loader=yaml.Loader, object_pairs_hook=dict):
     """
-    Load Yaml document, replace all hashes/mappings with AttrDict
+    Load Yaml document, replace all hashes/mappings with plain dicts
+
+    dicts are insertion-ordered since python 3.7, so the AttrDict
+    attribute-access wrapper only added per-lookup overhead
     """
     class Ordered_Loader(Loader):
         pass
@@ -80,21 +107,80 @@ def ordered_load(stream, Loader=yaml.Loader, object_pairs_hook=AttrDict):
 
 
 def yaml_load(filename):
+    """
+    Load a YAML file
+
+    YAML parsing is slow, so the parsed tree is cached in a pickle
+    sidecar next to the file. The sidecar is used as long as it is at
+    least as new as the YAML file, and rebuilt otherwise
+    """
+    cache = filename + ".pkl"
+    try:
+        if os.path.getmtime(cache) >= os.path.getmtime(filename):
+            with open(cache, "rb") as f:
+                return pickle.load(f)
+    except (OSError, pickle.PickleError):
+        pass    # no usable cache, parse the YAML file
+
     with open(filename, "r") as f:
         try:
-            data = ordered_load(f, yaml.SafeLoader)
-            return data
+            data = ordered_load(f, YamlSafeLoader)
         except yaml.YAMLError as err:
             raise UtilException("Cannot load YAML file %s, err: %s" % (filename, err))
 
+    try:
+        with open(cache + ".tmp", "wb") as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(cache + ".tmp", cache)
+    except OSError:
+        pass    # cache directory not writable, ignore
+    return data
+
 
 # ----- Read configuration file ----------------------------------------------
 
 conf = yaml_load(CONFIG_FILE)
 
-log.setLevel(conf.log.level)
+log.setLevel(conf["log"]["level"])
+
+# Resolve the playsms callback settings once at startup, instead of
+# hard-coded values / config lookups on the per-SMS path
+_playsms_conf = conf.get("playsms", {})
+_PLAYSMS_URL = _playsms_conf.get("callback", "http://127.0.0.1/playsms/plugin/gateway/generic/callback.php?")
+_PLAYSMS_AUTHCODE = _playsms_conf.get("authcode", "fc5fc18a232c42cf17a5be44f5a018314422505d")
+_PLAYSMS_TO = _playsms_conf.get("to", "+46705747187")
+_PLAYSMS_SMSC = _playsms_conf.get("smsc", "generic")
+
+usb_modem = USB_modem(
+    ucs2_hex_content=conf.get("modem", {}).get("ucs2_hex_content", False))
+
 
-usb_modem = USB_modem()
+# ----- Modem send worker ----------------------------------------------------
+
+# There is one physical modem, so sends are funneled through a single
+# consumer thread. HTTP handler threads enqueue a job and wait on its
+# future instead of contending directly for the modem
+
+class SendJob:
+    def __init__(self, numbers, text):
+        self.numbers = numbers
+        self.text = text
+        self.future = concurrent.futures.Future()
+
+
+modem_q = queue.SimpleQueue()
+
+
+def _modem_worker():
+    while True:
+        job = modem_q.get()
+        try:
+            job.future.set_result(usb_modem.send_sms(numbers=job.numbers, text=job.text))
+        except Exception as err:
+            job.future.set_exception(err)
+
+
+threading.Thread(target=_modem_worker, daemon=True).start()
 
 
 class PlaySMS:
@@ -102,51 +188,117 @@ class PlaySMS:
     Handle communication to/from PlaySMS
     """
     def __init__(self):
+        # shared pooled session, all callbacks reuse one keep-alive
+        # connection to playsms
+        self.session = _session
+
+        # Pool for the playsms callbacks, so slow callbacks do not
+        # block the poll loop or the modem delete
+        self._cb_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+
+        # set to wake the poller immediately, instead of waiting out
+        # the current poll interval
+        self.wake = threading.Event()
+
         self.thread = threading.Thread(target=self.background_poller, args=())
         self.thread.daemon = True
         self.thread.start()
 
-    
+
     def background_poller(self):
         """
         Separate thread, that periodically polls modem for new messages
+
+        The poll interval is adaptive: re-poll quickly after a batch
+        (more messages are probably queued), back off while idle
         """
+        interval = 10
         while True:
-            messages = usb_modem.list_received_sms()
-            for message in messages:
-                log.info("Received SMS index: %s  from: %s  message: %s" % (message.Index, message.Phone, message.Content))
-                playsms.insert_sms_into_playsms(id=message.Index, from_=message.Phone, text=message.Content)
-                usb_modem.delete_sms(message.Index)
-            time.sleep(10)
+            try:
+                messages = usb_modem.list_received_sms()
+                if messages:
+                    for message in messages:
+                        log.info("Received SMS index: %s  from: %s  message: %s", message.Index, message.Phone, message.Content)
+                    # forward to playsms first; only delete what playsms
+                    # accepted, the rest stays on the modem for a retry
+                    ok_indices = self.insert_sms_batch(messages)
+                    if ok_indices:
+                        usb_modem.delete_sms(ok_indices)
+                    interval = 1
+                else:
+                    interval = min(interval * 2, 60)
+            except Exception as err:
+                # a transient modem error must not kill the poller,
+                # back off and retry
+                log.error("Poll failed: %s", err)
+                interval = min(interval * 2, 60)
+            self.wake.wait(interval)
+            self.wake.clear()
+
+
+    def kick(self):
+        """
+        Wake the poller immediately, for an extra sweep of the modem
+        """
+        self.wake.set()
             
     
+    # Constant per process, build once instead of per received SMS
+    _CALLBACK_URL = _PLAYSMS_URL
+    _CALLBACK_HEADERS = {
+        'Content-Type'    : 'application/x-www-form-urlencoded',
+        'charset'        : 'UTF-8',
+        'Accept'        : 'application/json',
+        }
+    _CALLBACK_STATIC = {
+        'authcode': _PLAYSMS_AUTHCODE,
+        'to': _PLAYSMS_TO,
+        'smsc': _PLAYSMS_SMSC,
+        }
+
+    def insert_sms_batch(self, messages):
+        """
+        Forward a batch of received SMS to playsms, in parallel over
+        the callback pool
+
+        The generic gateway callback only accepts one message per
+        request, so the rows go to the callback pool and share one
+        keep-alive connection instead of a handshake per message
+
+        Returns the indices of the messages playsms accepted, so the
+        caller can delete exactly those from the modem
+        """
+        futures = []
+        for message in messages:
+            future = self._cb_pool.submit(self.insert_sms_into_playsms,
+                                          id=message.Index, from_=message.Phone, text=message.Content)
+            futures.append((message, future))
+
+        ok_indices = []
+        for message, future in futures:
+            try:
+                r = future.result()
+                if r.status_code == 200:
+                    ok_indices.append(message.Index)
+            except Exception as err:
+                log.error("playsms callback failed for SMS index %s: %s", message.Index, err)
+        return ok_indices
+
+
     def insert_sms_into_playsms(self, id=None, from_=None, to=None, text=None):
 #        http://10.10.80.129/playsms/plugin/gateway/generic/callback.php?
 #        &from=0722060322&message=nisse&to=46705747187&smsc=generic
 
-        data = AttrDict()
-        data.id = id
-        data.authcode = "fc5fc18a232c42cf17a5be44f5a018314422505d"
-        data['from'] = from_        # from is a python reserved keyword
-        data.message = text
-        data.to = "+46705747187"
-        data.smsc = 'generic'
-        
-        headers = {
-            'Content-Type'    : 'application/x-www-form-urlencoded',
-            'charset'        : 'UTF-8',
-            'Accept'        : 'application/json',
-            }
-        
-        url = "http://127.0.0.1/playsms/plugin/gateway/generic/callback.php?"
-        r = requests.post(url, headers=headers, data=data, timeout=10)
+        # plain dict is enough for requests, and 'from' is a python
+        # reserved keyword, hence from_
+        data = {**self._CALLBACK_STATIC, 'id': id, 'from': from_, 'message': text}
+
+        r = self.session.post(self._CALLBACK_URL, headers=self._CALLBACK_HEADERS, data=data, timeout=10)
+        if r.status_code != 200:
+            log.error("playsms callback returned %s for SMS index %s", r.status_code, id)
         return r
 
-#        url += urllib.parse.urlencode(data, encoding='utf-8')
-#        url += urllib.parse.urlencode(data)
-#        ret = requests.get(url=url).text
-#        return ret
-    
+
     def sms_from_playsms(self):
         pass
 
@@ -154,6 +306,31 @@ class PlaySMS:
 playsms = PlaySMS()
 
 
+# constant response bodies, encoded once
+_UNKNOWN_API = b"Unknown API call\n"
+_MISSING_PARAMS = b"Missing message or msisdn\n"
+_SEND_FAILED = b"Send failed\n"
+
+
+def parse_send_qs(query):
+    """
+    Extract the message text and msisdn numbers from a send_sms query
+    string. One scan, no intermediate dict-of-lists as with parse_qs
+    """
+    text = None
+    numbers = []
+    for pair in query.split('&'):
+        if '=' not in pair:
+            continue
+        key, value = pair.split('=', 1)
+        value = urllib.parse.unquote_plus(value)
+        if key == 'message' and text is None:
+            text = value
+        elif key == 'msisdn':
+            numbers.append(value)
+    return text, numbers
+
+
 class RequestHandler(BaseHTTPRequestHandler):
     """
     HTTP server
@@ -161,6 +338,14 @@ class RequestHandler(BaseHTTPRequestHandler):
     Receive the message and send it to the USB modem
     """
 
+    # HTTP/1.1 so playsms can reuse the connection between sends.
+    # Requires Content-Length on every response, see _return
+    protocol_version = "HTTP/1.1"
+
+    # reap idle keep-alive connections, so they cannot pin all the
+    # worker pool threads
+    timeout = 30
+
     def log_message(self, format_, *args):
         """
         Supress all handled URLs output to stdout
@@ -171,39 +356,63 @@ class RequestHandler(BaseHTTPRequestHandler):
         # Write content as utf-8 data
         if isinstance(message, str):
             message = bytes(message, "utf8")
-        self.send_response(response_code)
-       
-        self.send_header('Content-type', content_type)
-#        self.send_header('Content-Length',str(len(message)))       # only needed for http 1.1 ?
-        self.end_headers()
-        self.wfile.write(message)
+
+        # build the whole response and write it in one go; wfile is
+        # unbuffered, so every send_header call was its own write(2)
+        phrase = self.responses.get(response_code, ('', ''))[0]
+        head = ("HTTP/1.1 %d %s\r\n"
+                "Content-Type: %s\r\n"
+                "Content-Length: %d\r\n"
+                "Connection: keep-alive\r\n"
+                "\r\n" % (response_code, phrase, content_type, len(message))).encode('latin1')
+        self.wfile.write(head + message)
         
     def _return_json(self, response_code, data):
-        jsondata = json.dumps(data)
-        self._return(response_code, jsondata, content_type="application/json")
+        self._return(response_code, _json_dumps(data), content_type="application/json")
 
     def do_GET(self):
-        log.debug("path %s" % self.path)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("path %s", self.path)
         path = self.path
 
         if path.startswith("/api/send_sms"):
-            query = urllib.parse.urlparse(self.path).query
-            args = urllib.parse.parse_qs(query, encoding='utf-8')
-            text = args["message"][0]
-            numbers = args["msisdn"]
-            index = usb_modem.send_sms(numbers=numbers, text=text)
-            return self._return_json(200, "%s OK" % index)
-                
-        return self._return(401, "Unknown API call\n")
-
-
-class ThreadingServer(ThreadingMixIn, HTTPServer):
-    pass
+            query = path.split("?", 1)[1] if "?" in path else ""
+            text, numbers = parse_send_qs(query)
+            if text is None or not numbers:
+                return self._return(400, _MISSING_PARAMS)
+            job = SendJob(numbers, text)
+            modem_q.put(job)
+            try:
+                index = job.future.result(timeout=30)
+            except Exception as err:
+                log.error("send_sms failed: %s", err)
+                return self._return(500, _SEND_FAILED)
+            # sweep the modem right away, a reply may already be waiting
+            playsms.kick()
+            # the response is just a JSON string, quote it directly
+            # instead of going through the JSON encoder
+            return self._return(200, b'"%s OK"' % str(index).encode(),
+                                content_type="application/json")
+
+        return self._return(401, _UNKNOWN_API)
+
+
+class ThreadingServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 32
+
+    def __init__(self, *args, **kwargs):
+        # bounded worker pool, instead of one new OS thread per request
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=8)
+        super().__init__(*args, **kwargs)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--server", 
+    parser.add_argument("--server",
                         default=False,
                         action="store_true",
                         help="Run as a server, interfacing with playSMS")
@@ -211,8 +420,8 @@ def main():
     args = parser.parse_args()
 
     if args.server:
-        log.info('starting HTTP server on port %s' % (conf.http_server.port))
-        server_address = ('127.0.0.1', conf.http_server.port)
+        log.info('starting HTTP server on port %s', conf["http_server"]["port"])
+        server_address = ('127.0.0.1', conf["http_server"]["port"])
         httpd = ThreadingServer(server_address, RequestHandler)
         httpd.serve_forever()
     else: